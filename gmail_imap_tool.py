@@ -20,166 +20,600 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import email
+import contextlib
+import functools
+import io
 import logging
-from datetime import datetime
-from typing import List
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Tuple, Union
 
 import appdirs
 import click
 import click_config_file
 import click_log
-from imapclient import IMAPClient
+
+# imapclient and email are imported where they are used to keep CLI startup
+# fast, e.g. for --help.
+if TYPE_CHECKING:
+    import email.parser
+
+    from imapclient import IMAPClient
 
 logger = logging.getLogger(__name__)
 click_log.basic_config(logger)
 
 
+class ConnectionPool:
+    # Connections idle for longer than this are checked with NOOP before
+    # being handed out again.
+    idle_timeout = 30.0
+
+    def __init__(
+        self, username: str, password: str, compress: bool = True, size: int = 0
+    ) -> None:
+        self.username = username
+        self.password = password
+        self.compress = compress
+        self.size = size
+        self._warmed = False
+        self._idle: List[Tuple["IMAPClient", float]] = []
+        self._lock = threading.Lock()
+
+    def warm(self, size: int) -> None:
+        # Log in concurrently; connecting one at a time would be slower than
+        # letting each stripe open its own connection.
+        missing = size - len(self._idle)
+        if missing <= 0:
+            return
+
+        error = None
+        with ThreadPoolExecutor(max_workers=missing) as executor:
+            futures = [
+                executor.submit(
+                    imap_connect, self.username, self.password, self.compress
+                )
+                for _ in range(missing)
+            ]
+            for future in futures:
+                try:
+                    self.release(future.result())
+                except Exception as exc:
+                    error = error or exc
+
+        if error is not None:
+            raise error
+
+    def acquire(self) -> "IMAPClient":
+        from imapclient import IMAPClient
+
+        # Warm on first use rather than at startup, so --help and usage errors
+        # never log in.
+        with self._lock:
+            warm, self._warmed = not self._warmed, True
+        if warm:
+            self.warm(self.size)
+
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                client, released = self._idle.pop()
+
+            if time.monotonic() - released < self.idle_timeout:
+                return client
+
+            try:
+                client.noop()
+                return client
+            except (IMAPClient.Error, OSError) as error:
+                logger.debug("Discarding broken connection: %s", error)
+                try:
+                    client.shutdown()
+                except OSError:
+                    pass
+
+        return imap_connect(self.username, self.password, self.compress)
+
+    def release(self, client: "IMAPClient") -> None:
+        with self._lock:
+            self._idle.append((client, time.monotonic()))
+
+    @contextlib.contextmanager
+    def connection(self) -> Iterator["IMAPClient"]:
+        # A connection that saw an error may be mid-command, so log it out
+        # rather than handing it to the next user.
+        client = self.acquire()
+        ok = False
+        try:
+            yield client
+            ok = True
+        finally:
+            if ok:
+                self.release(client)
+            else:
+                self._logout(client)
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for client, _ in idle:
+            self._logout(client)
+
+    @staticmethod
+    def _logout(client: "IMAPClient") -> None:
+        from imapclient import IMAPClient
+
+        try:
+            client.logout()
+        except (IMAPClient.Error, OSError) as error:
+            logger.debug("Failed to logout cleanly: %s", error)
+
+
 class GlobalOpts:
     username: str
     password: str
+    pool: ConnectionPool
 
 
-@click.group()
+@click.group(chain=True)
 @click.option("--username", required=True, help="GMAIL username.", prompt=True)
 @click.option(
     "--password", required=True, help="GMAIL password.", prompt=True, hide_input=True
 )
+@click.option(
+    "--pool-size",
+    default=1,
+    type=click.IntRange(0, 8),
+    help="Number of IMAP connections to open on first use, shared by chained commands.",
+)
+@click.option(
+    "--compress/--no-compress",
+    default=True,
+    help="Use COMPRESS=DEFLATE when the server supports it.",
+)
 @click_log.simple_verbosity_option(logger)
 @click_config_file.configuration_option(
     config_file_name=appdirs.user_config_dir("gmail.cfg")
 )
 @click.pass_context
-def gmail_imap_tool(ctx: click.Context, username: str, password: str):
+def gmail_imap_tool(
+    ctx: click.Context, username: str, password: str, pool_size: int, compress: bool
+):
     global_opts = ctx.obj
     global_opts.username = username
     global_opts.password = password
+    global_opts.pool = ConnectionPool(username, password, compress, pool_size)
+    ctx.call_on_close(global_opts.pool.close)
 
 
 @gmail_imap_tool.command()
-@click.option("--chunk-size", default=1024, help="GMAIL folder to delete.")
+@click.option(
+    "--chunk-size",
+    default=1024,
+    type=click.IntRange(min=0),
+    help="Messages per STORE command, 0 to delete the whole folder at once.",
+)
 @click.option("--confirm/--no-confirm", default=True, help="Just do it.")
+@click.option(
+    "--connections",
+    default=4,
+    type=click.IntRange(1, 8),
+    help="Number of IMAP connections to delete with.",
+)
 @click.option("--folder", required=True, help="GMAIL folder to delete.")
+@click.option(
+    "--pipeline-depth",
+    default=4,
+    type=click.IntRange(1, 64),
+    help="Chunks in flight per connection before waiting for responses.",
+)
 @click.pass_context
 def delete_folder(
-    ctx: click.Context, chunk_size: int, confirm: bool, folder: str
+    ctx: click.Context,
+    chunk_size: int,
+    confirm: bool,
+    connections: int,
+    folder: str,
+    pipeline_depth: int,
 ) -> None:
     global_opts = ctx.obj
 
     logger.info(f"Removing folder {folder!r}...")
-    client = imap_connect(global_opts.username, global_opts.password)
-
-    logger.info(f"Selecting folder {folder!r}...")
-    resp = client.select_folder(folder)
-    logger.debug(f"select_folder response: {resp!r}")
-
-    logger.info(f"Searching messages in folder {folder!r}...")
-    message_ids = client.search()
-    num_messages = len(message_ids)
-    logger.info(f"Found {num_messages} in folder {folder!r}.")
-
-    if confirm and click.confirm(
-        f"Do you want to preview some of the messages from {folder!r}?"
-    ):
-        preview_ids = list(set(message_ids[:128] + message_ids[-128:]))
-        print_emails(client, preview_ids)
-
-    if not confirm or click.confirm(
-        f"Do you want to delete {num_messages} messages from {folder!r}?"
-    ):
-        while len(message_ids) > 0:
-            current_ids = message_ids[:chunk_size]
-            logger.info(
-                "[{}] Deleting {} of {} messages, {} to go...".format(
-                    datetime.now(), len(current_ids), num_messages, len(message_ids)
-                )
-            )
-            message_ids = message_ids[chunk_size:]
-
-            logger.debug("Setting label to Trash...")
-            resp = client.set_gmail_labels(current_ids, "\\Trash")
-            logger.debug("set_gmail_labels response:", resp)
+    with global_opts.pool.connection() as client:
+        # When confirming, the user may back out after looking, so only EXAMINE
+        # the folder until they agree to delete.
+        logger.info(f"Selecting folder {folder!r}...")
+        resp = client.select_folder(folder, readonly=confirm)
+        logger.debug("select_folder response: %r", resp)
+
+        # Deleting the whole folder in one go only needs the message count, so
+        # skip materializing every UID unless chunking or previewing.
+        message_ids: List[int] = []
+        if chunk_size > 0:
+            logger.info(f"Searching messages in folder {folder!r}...")
+            message_ids = client.search()
+            num_messages = len(message_ids)
+        else:
+            num_messages = resp[b"EXISTS"]
+        logger.info(f"Found {num_messages} in folder {folder!r}.")
 
-            logger.debug("Deleting messages...")
-            resp = client.delete_messages(current_ids)
-            logger.debug(f"delete_messages response: {resp!r}")
+        if confirm and click.confirm(
+            f"Do you want to preview some of the messages from {folder!r}?"
+        ):
+            if not message_ids:
+                message_ids = client.search()
+            preview_ids = list(dict.fromkeys([*message_ids[:128], *message_ids[-128:]]))
+            print_emails(client, preview_ids)
 
-        logger.info("Expunging messages...")
-        client.expunge()
+        if not confirm or click.confirm(
+            f"Do you want to delete {num_messages} messages from {folder!r}?"
+        ):
+            if confirm:
+                resp = client.select_folder(folder)
+                logger.debug("select_folder response: %r", resp)
+
+            if chunk_size <= 0:
+                if num_messages > 0:
+                    logger.info(f"Deleting all {num_messages} messages...")
+                    resp = _pipelined_delete(client, [b"1:*"])
+                    logger.debug("_pipelined_delete response: %r", resp)
+            else:
+                # Each stripe is deleted over its own connection, overlapping the
+                # per-chunk round-trips.  Gmail allows ~15 concurrent sessions.
+                stripe_size = max(1, -(-num_messages // connections))
+                stripes = [
+                    message_ids[start : start + stripe_size]
+                    for start in range(0, num_messages, stripe_size)
+                ]
+                progress = _DeleteProgress(num_messages)
+                stop = threading.Event()
+                with ThreadPoolExecutor(max_workers=connections) as executor:
+                    futures = [
+                        executor.submit(
+                            _delete_stripe,
+                            global_opts.pool,
+                            folder,
+                            stripe,
+                            chunk_size,
+                            pipeline_depth,
+                            index,
+                            progress,
+                            stop,
+                        )
+                        for index, stripe in enumerate(stripes, 1)
+                    ]
+                    # The executor waits for running stripes on exit, so on
+                    # Ctrl-C or a failed stripe tell the others to stop at
+                    # their next window rather than deleting everything.
+                    try:
+                        for future in as_completed(futures):
+                            future.result()
+                    except BaseException:
+                        stop.set()
+                        raise
+
+            logger.info("Expunging messages...")
+            client.expunge()
 
-    client.close_folder()
-    client.logout()
+        client.close_folder()
 
 
 @gmail_imap_tool.command()
 @click.option("--confirm/--no-confirm", default=True, help="Just do it.")
 @click.pass_context
 def delete_empty_folders(ctx: click.Context, confirm: bool) -> None:
+    from imapclient import IMAPClient
+
     global_opts = ctx.obj
 
     logger.info("Removing empty folders...")
-    client = imap_connect(global_opts.username, global_opts.password)
-
-    for raw_folder in list(client.list_folders()):
-        folder = str(raw_folder[2])
-        if len(folder) > 1:
-            if folder.startswith("[Gmail]"):
-                logger.info(f"Skipping GMAIL-specific folder: {folder!r}")
-                continue
-
-        logger.debug(f"Selecting folder {folder!r}...")
-        try:
+    with global_opts.pool.connection() as client:
+        folders = []
+        for raw_folder in list(client.list_folders()):
+            folder = str(raw_folder[2])
+            if len(folder) > 1:
+                if folder.startswith("[Gmail]"):
+                    logger.info(f"Skipping GMAIL-specific folder: {folder!r}")
+                    continue
+            folders.append(folder)
+
+        logger.debug("Querying status of %d folders...", len(folders))
+        statuses = _pipelined_message_counts(client, folders)
+
+        for folder in folders:
             print(folder)
-            resp = client.select_folder(folder)
-            logger.debug(f"select_folder response: {resp!r}")
-        except IMAPClient.Error as error:
-            logger.info(f"Skipping mailbox {folder!r} due to error: {error}")
-            continue
-
-        logger.debug(f"Searching messages in folder {folder!r}...")
-        message_ids = client.search()
-        num_messages = len(message_ids)
-        logger.info(f"Found {num_messages} in folder {folder!r}.")
-
-        client.close_folder()
+            num_messages = statuses.get(folder, IMAPClient.Error("no STATUS response"))
+            if isinstance(num_messages, IMAPClient.Error):
+                logger.info(f"Skipping mailbox {folder!r} due to error: {num_messages}")
+                continue
 
-        if num_messages > 0:
-            continue
+            logger.info(f"Found {num_messages} in folder {folder!r}.")
 
-        if not confirm or click.confirm(
-            f"Do you want to delete empty folder {folder!r}?"
-        ):
-            logger.debug(f"Deleting folder {folder!r}...")
-            resp = client.delete_folder(folder)
-            logger.debug(f"delete_folder response: {resp!r}")
+            if num_messages > 0:
+                continue
 
-    client.logout()
+            if not confirm or click.confirm(
+                f"Do you want to delete empty folder {folder!r}?"
+            ):
+                logger.debug("Deleting folder %r...", folder)
+                resp = client.delete_folder(folder)
+                logger.debug("delete_folder response: %r", resp)
 
 
 @gmail_imap_tool.command()
 @click.pass_context
 def print_folders(ctx: click.Context) -> None:
     global_opts = ctx.obj
-    client = imap_connect(global_opts.username, global_opts.password)
-    for folder in client.list_folders():
-        name = folder[2]
-        logger.info(name)
-    client.logout()
+    with global_opts.pool.connection() as client:
+        for folder in client.list_folders():
+            name = folder[2]
+            logger.info(name)
+
 
+def imap_connect(username: str, password: str, compress: bool = True) -> "IMAPClient":
+    from imapclient import IMAPClient
 
-def imap_connect(username: str, password: str) -> IMAPClient:
     logger.info("Connecting to GMAIL...")
     client = IMAPClient("imap.gmail.com", ssl=True)
     client.login(username, password)
+    if compress and client.has_capability("COMPRESS=DEFLATE"):
+        _enable_compression(client)
     logger.info("Connected.")
     return client
 
 
-def print_emails(client: IMAPClient, message_ids: List[int]) -> None:
-    messages = client.fetch(message_ids, ("RFC822",))
-    for message in messages.values():
-        message_data = message[b"RFC822"]
-        message = email.message_from_bytes(message_data)
+class _DeflateReader:
+    # Stands in for imaplib's socket file, inflating the server's stream.
+    def __init__(self, raw: io.BufferedReader) -> None:
+        self._raw = raw
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._buffer = bytearray()
+
+    def _fill(self) -> bool:
+        data = self._raw.read1(16384)
+        if not data:
+            return False
+        self._buffer += self._decompressor.decompress(data)
+        return True
+
+    def _take(self, size: int) -> bytes:
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read(self, size: int) -> bytes:
+        while len(self._buffer) < size and self._fill():
+            pass
+        return self._take(size)
+
+    def readline(self, limit: int = -1) -> bytes:
+        while True:
+            end = self._buffer.find(b"\n") + 1
+            if end or 0 <= limit <= len(self._buffer) or not self._fill():
+                break
+        if not end:
+            end = len(self._buffer)
+        if limit >= 0:
+            end = min(end, limit)
+        return self._take(end)
+
+    def close(self) -> None:
+        self._raw.close()
+
+
+def _enable_compression(client: "IMAPClient") -> None:
+    # RFC 4978: once the server acknowledges COMPRESS, everything after the
+    # tagged OK is raw DEFLATE in both directions.
+    typ, data = client._raw_command(b"COMPRESS", [b"DEFLATE"], uid=False)
+    client._checkok("compress", typ, data)
+
+    imap = client._imap
+    compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS
+    )
+
+    def send(data: bytes) -> None:
+        imap.sock.sendall(
+            compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        )
+
+    imap.file = _DeflateReader(imap.file)
+    imap.send = send
+
+
+class _DeleteProgress:
+    # Shared by the stripe workers so progress is reported against the
+    # whole folder rather than per stripe.
+    def __init__(self, total: int) -> None:
+        self.total = total
+        self.remaining = total
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def advance(self, count: int) -> int:
+        # Returns the number of messages left before this chunk.
+        with self._lock:
+            remaining = self.remaining
+            self.remaining -= count
+        return remaining
+
+
+def _delete_stripe(
+    pool: ConnectionPool,
+    folder: str,
+    message_ids: List[int],
+    chunk_size: int,
+    pipeline_depth: int,
+    index: int,
+    progress: _DeleteProgress,
+    stop: threading.Event,
+) -> None:
+    with pool.connection() as client:
+        client.select_folder(folder)
+
+        num_messages = len(message_ids)
+        window_size = chunk_size * pipeline_depth
+        for window_start in range(0, num_messages, window_size):
+            if stop.is_set():
+                logger.info("Stripe %d: stopping.", index)
+                return
+
+            window_end = min(window_start + window_size, num_messages)
+            sequence_sets = []
+            for start in range(window_start, window_end, chunk_size):
+                current_ids = message_ids[start : start + chunk_size]
+                remaining = progress.advance(len(current_ids))
+                logger.info(
+                    "[%.1fs] Stripe %d: deleting %d of %d messages, %d to go...",
+                    time.monotonic() - progress.started,
+                    index,
+                    len(current_ids),
+                    progress.total,
+                    remaining,
+                )
+                sequence_sets.append(_sequence_set(current_ids))
+
+            logger.debug("Setting label to Trash and deleting messages...")
+            resp = _pipelined_delete(client, sequence_sets)
+            logger.debug("_pipelined_delete response: %r", resp)
+
+
+def _pipelined_message_counts(
+    client: "IMAPClient", folders: List[str], batch_size: int = 100
+) -> Dict[str, Union[int, "IMAPClient.Error"]]:
+    from imapclient import IMAPClient
+    from imapclient.imap_utf7 import decode as decode_utf7
+    from imapclient.response_parser import parse_response
+
+    # Write a batch of STATUS commands before reading any response, so each
+    # batch costs a single round-trip rather than one per folder. Bounding
+    # the batch keeps unread replies from filling the socket buffers.
+    imap = client._imap
+    statuses: Dict[str, Union[int, "IMAPClient.Error"]] = {}
+    for batch_start in range(0, len(folders), batch_size):
+        tags = [
+            (
+                folder,
+                imap._command("STATUS", client._normalise_folder(folder), "(MESSAGES)"),
+            )
+            for folder in folders[batch_start : batch_start + batch_size]
+        ]
+
+        for folder, tag in tags:
+            try:
+                typ, data = imap._command_complete("STATUS", tag)
+                client._checkok("status", typ, data)
+            except IMAPClient.Error as error:
+                statuses[folder] = error
+
+    # Untagged STATUS responses are collected in arrival order; match them
+    # back to folders by the mailbox name the server echoes.
+    response = parse_response(imap.untagged_responses.pop("STATUS", []))
+    for name, items in zip(response[::2], response[1::2]):
+        if isinstance(name, int):
+            name = str(name)
+        elif client.folder_encode:
+            name = decode_utf7(name)
+        statuses[name] = dict(zip(items[::2], items[1::2]))[b"MESSAGES"]
+    return statuses
+
+
+def _sequence_set(message_ids: List[int]) -> bytes:
+    # Collapse runs of consecutive UIDs into ranges, e.g. 1:1024,2000:2047,
+    # to keep commands short and under Gmail's request size limit.
+    ranges: List[List[int]] = []
+    for uid in sorted(message_ids):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return b",".join(
+        b"%d" % first if first == last else b"%d:%d" % (first, last)
+        for first, last in ranges
+    )
+
+
+def _pipelined_delete(client: "IMAPClient", sequence_sets: List[bytes]) -> List[bytes]:
+    # Write every STORE before reading any response (RFC 3501, 5.5) so a
+    # whole window of chunks costs one round-trip. SILENT keeps the replies
+    # to a single tagged line each, so they cannot back up the socket.
+    # Bind the per-command callables once per window rather than looking
+    # them up again for every STORE.
+    command = client._imap._command
+    command_complete = client._imap._command_complete
+    checkok = client._checkok
+
+    tags = []
+    for ids in sequence_sets:
+        tags.append(command("UID", "STORE", ids, "X-GM-LABELS.SILENT", "(\\Trash)"))
+        tags.append(command("UID", "STORE", ids, "+FLAGS.SILENT", "(\\Deleted)"))
+
+    responses = []
+    for tag in tags:
+        typ, data = command_complete("STORE", tag)
+        checkok("store", typ, data)
+        responses.append(data[0])
+    return responses
+
+
+def _iter_fetch(
+    client: "IMAPClient", message_ids: List[int], data: str
+) -> Iterator[Tuple[int, Dict[bytes, Any]]]:
+    from imapclient.response_parser import parse_fetch_response
+
+    # Yield each FETCH response as soon as it is read off the socket rather
+    # than buffering the whole reply like IMAPClient.fetch does.
+    if not message_ids:
+        return
+
+    imap = client._imap
+    tag = imap._command("UID", "FETCH", _sequence_set(message_ids), f"({data})")
+    while True:
+        imap._get_response()
+        responses = imap.untagged_responses.pop("FETCH", [])
+        if responses:
+            parsed = parse_fetch_response(
+                responses, client.normalise_times, client.use_uid
+            )
+            yield from parsed.items()
+        if imap.tagged_commands[tag]:
+            break
+
+    typ, data = imap.tagged_commands.pop(tag)
+    client._checkok("fetch", typ, data)
+
+
+@functools.lru_cache(maxsize=None)
+def _header_parser() -> "email.parser.BytesHeaderParser":
+    # Built once on first use; parsebytes keeps no state between calls.
+    import email.parser
+
+    return email.parser.BytesHeaderParser()
+
+
+def print_emails(client: "IMAPClient", message_ids: List[int]) -> None:
+    # Only the Subject header is printed, so don't download whole messages.
+    parser = _header_parser()
+    fetch = _iter_fetch(client, message_ids, "BODY.PEEK[HEADER.FIELDS (SUBJECT)]")
+    for _, response in fetch:
+        # Servers differ in how they echo the section, e.g. with the header
+        # name quoted, so match the item by prefix rather than exact key.
+        message_data = next(
+            (
+                value
+                for key, value in response.items()
+                if key.startswith(b"BODY[HEADER.FIELDS")
+            ),
+            None,
+        )
+        # Skip unsolicited FETCH responses, e.g. FLAGS updates.
+        if message_data is None:
+            continue
+        message = parser.parsebytes(message_data)
         logger.info(message["subject"])
 
 